@@ -1,16 +1,27 @@
 # %%
 from pymongo import MongoClient, UpdateOne # https://pymongo.readthedocs.io/en/stable/tutorial.html
+from pymongo.write_concern import WriteConcern
 import dns
 import requests
 import requests_cache # https://requests-cache.readthedocs.io/en/stable/
+from requests.adapters import HTTPAdapter
+from requests_cache.serializers import SerializerPipeline, Stage, pickle_serializer
+import zlib
 import datetime
-from typing import List, Dict, Tuple, Optional
+from typing import List, Dict, Set, Tuple, Optional
 import json
+import re
+import orjson # https://github.com/ijl/orjson
 import time
 from dotenv import load_dotenv
 import os
-from bs4 import BeautifulSoup
-import random
+from selectolax.lexbor import LexborHTMLParser # https://selectolax.readthedocs.io/en/latest/lexbor.html
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from scrape.ratelimit import TokenBucket
+from scrape.types import QUESTION_FIELDS
 
 
 load_dotenv()
@@ -29,22 +40,95 @@ def get_mongo_client() -> MongoClient:
 
 client = get_mongo_client()
 db = client['stackOverflowDB']
-questions = db['questions']
-answers = db['answers']
+
+# The scrape is an idempotent, resumable backfill, so writes only need to be
+# acknowledged by the primary, not synced to its journal. Scrape checkpoints
+# in `scrape_state` keep the default write concern, so a resumed run never
+# starts after answers that were lost.
+scrape_write_concern = WriteConcern(w=1, j=False)
+questions = db.get_collection('questions', write_concern=scrape_write_concern)
+answers = db.get_collection('answers', write_concern=scrape_write_concern)
+
+# %%
+def ensure_indexes() -> None:
+    """
+    Creates the indexes that answer lookups rely on. Questions and answers are
+    already keyed on `_id`, but answers are usually looked up by question, and
+    questions by tag. Creating an index that already exists does nothing, and
+    dropping a collection drops its indexes, so this runs before every scrape.
+    """
+
+    # Also covers plain question_id lookups, since it is the index's prefix
+    answers.create_index([('question_id', 1), ('score', -1)])
+    questions.create_index('tags')
+
+def get_scraped_question_ids() -> Set[int]:
+    """
+    Gets the ids of every question that already has answers stored. Resumed
+    scrapes use this to skip fetching those questions' answer pages again.
+    """
+    return set(answers.distinct('question_id'))
 
 # %%
 # Set up request caching for StackOverflow API
-session = requests_cache.CachedSession('.cache/stack_cache', cache_control=True, stale_if_error=True, backend='filesystem')
+# Responses are stored in a single SQLite file (WAL mode, so concurrent
+# answer-page workers don't block each other) and zlib-compressed, which
+# shrinks cached HTML pages several times over.
+compressed_serializer = SerializerPipeline(
+    [*pickle_serializer.stages, Stage(dumps=zlib.compress, loads=zlib.decompress)],
+    name='pickle+zlib',
+    is_binary=True,
+)
+session = requests_cache.CachedSession('.cache/stack_cache', cache_control=True, stale_if_error=True, backend='sqlite',
+                                       serializer=compressed_serializer, wal=True, fast_save=True)
+
+# Keep connections to the API and to stackoverflow.com alive between requests
+# instead of re-doing the TLS handshake. The pool is large enough for every
+# answer page worker to hold its own connection.
+session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=64))
+session.headers['Accept-Encoding'] = 'gzip, deflate'
+
+# %%
+# The API allows bursts, but stackoverflow.com is behind CloudFlare, which
+# will start blocking us if answer pages are requested too quickly.
+api_bucket = TokenBucket(rate=2, capacity=5)
+page_bucket = TokenBucket(rate=1.5, capacity=4)
 
 # %% [markdown]
 # # Getting StackOverflow Questions
 # 
-# Questions are procured from the [StackOverflow REST API](https://api.stackexchange.com/docs), specifically the [/questions endpoint](https://api.stackexchange.com/docs/questions#order=desc&sort=activity&tagged=c%3Bc%2B%2B&filter=default&site=stackoverflow). We'll be limiting our search to C/C++ code snippets for simplicity.
+# Questions are procured from the [StackOverflow REST API](https://api.stackexchange.com/docs), specifically the [/search/advanced endpoint](https://api.stackexchange.com/docs/advanced-search#order=desc&sort=activity&answers=1&tagged=c&filter=default&site=stackoverflow), which lets the API drop questions that have no answers for us. We'll be limiting our search to C/C++ code snippets for simplicity.
+
+# %%
+# Fields kept on each question returned by the API, the same ones the scraper
+# stores. Everything else (owner blobs, etc) is dropped server-side by a
+# custom filter.
+# https://api.stackexchange.com/docs/filters
+question_fields = list(QUESTION_FIELDS)
+
+def get_question_filter() -> str:
+    """
+    Creates a StackExchange API filter that only includes `question_fields`
+    and the wrapper fields we read. Filters are immutable, so the response is
+    served from the request cache after the first call.
+    """
+    wrapper_fields = ['items', 'has_more', 'quota_max', 'quota_remaining', 'backoff', 'error_id', 'error_message', 'error_name']
+    include = [f'.{field}' for field in wrapper_fields] + [f'question.{field}' for field in question_fields]
+
+    r = session.get('https://api.stackexchange.com/2.3/filters/create', params={
+        'base': 'none',
+        'include': ';'.join(include),
+        'unsafe': 'false'
+    })
+    r.raise_for_status()
+    return r.json()['items'][0]['filter']
 
 # %%
 def get_stackoverflow_questions(**kwargs):
     """
-    
+    Yields answered questions from the Stack API one at a time. Questions are
+    requested in pages of `pagesize`, but callers are free to batch them
+    however they like.
     """
     
     pagesize: int = kwargs.get('pagesize', 100) # How many questions to return per page
@@ -68,8 +152,10 @@ def get_stackoverflow_questions(**kwargs):
         'sort': 'activity',
         'order': 'desc',
         'tagged': 'c',
+        'answers': 1, # Only questions with at least one answer
         'pagesize': pagesize,
-        'todate': int(question_boundary_younger.timestamp())
+        'todate': int(question_boundary_younger.timestamp()),
+        'filter': get_question_filter()
     }
 
     # Include the API key if one was provided
@@ -82,7 +168,8 @@ def get_stackoverflow_questions(**kwargs):
 
         # Returns a Common Wrapper Object
         # https://api.stackexchange.com/docs/wrapper
-        r = session.get('https://api.stackexchange.com/2.3/questions', params=query_params)
+        api_bucket.acquire()
+        r = session.get('https://api.stackexchange.com/2.3/search/advanced', params=query_params)
 
         if r.status_code > 299:
             if r.headers['content-length'] == 0:
@@ -102,10 +189,10 @@ def get_stackoverflow_questions(**kwargs):
         page += 1
 
         # Yield each question in the response
-        body = r.json()
+        body = orjson.loads(r.content)
         assert 'items' in body
         assert isinstance(body['items'], list)
-        yield body['items']
+        yield from body['items']
 
         # Check if we're done
         quota_remaining = body['quota_remaining']
@@ -119,14 +206,15 @@ def get_stackoverflow_questions(**kwargs):
         # Check if we need to back off before sending more requests. Only necessary if we're not done.
         backoff = body.get('backoff', 0)
         if not done and backoff > 0:
-            print(f'Backoff requested, sleeping for {backoff} seconds')
-            time.sleep(backoff)
+            print(f'Backoff requested, pausing requests for {backoff} seconds')
+            api_bucket.pause(backoff)
 
 
 # %%
 # This takes a while, is expensive, and is only necessary once. This flag
-# lets you skip this step if you've already run it.
-should_scrape = True
+# lets you skip this step if you've already run it. Fresh scrapes should use the
+# single-pass question and answer scrape at the end of the notebook instead.
+should_scrape = False
 drop = False
 page_size = 100  # Number of questions to return per page
 page = 185       # Starting page index, 1-indexed. Useful for continuing where you left off in the event of a crash
@@ -139,15 +227,16 @@ if should_scrape:
         
     print('Scraping questions')
     # Scrape each page, bulk inserting each one into mongo
-    for page in get_stackoverflow_questions(page=page, maxpages=100, pagesize=page_size):
-        if type(page) is not list:
-            assert type(page) is dict
-            page = [page]
+    # Questions are yielded one at a time, so batches can span API pages
+    upserts: List[UpdateOne] = []
+    for q in get_stackoverflow_questions(page=page, maxpages=100, pagesize=page_size):
+        upserts.append(UpdateOne({'_id': q['question_id']}, {'$set': q}, upsert=True))
+        if len(upserts) >= 1000:
+            questions.bulk_write(upserts, ordered=False)
+            upserts = []
 
-        page = filter(lambda q: q['answer_count'] > 0, page)
-        upserts = [UpdateOne({'_id': q['question_id']}, {'$set': q}, upsert=True) for q in page]
-        questions.bulk_write(upserts)
-        time.sleep(0.5 + random.random() / 2) # Sleep for a bit to avoid hitting the API too hard
+    if upserts:
+        questions.bulk_write(upserts, ordered=False)
 
 
 # %%
@@ -159,63 +248,94 @@ for j in range(1, 5):
 # # Scraping StackOverflow Answers
 
 # %%
-def get_questions(**kwargs):
-    pagesize = kwargs.get('pagesize', 100) # How many questions to return per page
-    assert 1 <= pagesize 
+scrape_state = db['scrape_state']
 
-    page = kwargs.get('page', 1)           # Starting page index, 1-indexed
-    assert page >= 1
+def get_question_links(last_id: Optional[int] = None) -> Dict[str, int]:
+    """
+    Maps the link of every question after `last_id` to its id, in `_id` order.
 
-    # Calculate number of documents to skip
-    skips = page_size * (page_num - 1)
+    Scraping answers only needs each question's link and id, so both are read
+    in one pass over the `_id` index up front. This avoids skip/limit paging,
+    which makes the server scan every skipped document, and keeps a mongo
+    cursor from sitting open for the whole scrape.
+    """
+    query = {'_id': {'$gt': last_id}} if last_id is not None else {}
+    cursor = questions.find(query, projection={'link': 1}).sort('_id', 1).hint('_id_').batch_size(10000)
+    return {doc['link']: doc['_id'] for doc in cursor}
 
-    # Skip and limit
-    cursor = questions.find().skip(skips).limit(page_size)
-    for doc in cursor:
-        yield doc
+def load_checkpoint() -> Optional[int]:
+    """
+    Gets the `_id` of the last question whose answers were stored, if any.
+    """
+    state = scrape_state.find_one({'_id': 'answers'})
+    return state['last_id'] if state else None
+
+def save_checkpoint(last_id: int) -> None:
+    """
+    Records the `_id` of the last question whose answers were stored, so a
+    crashed scrape can resume where it left off.
+    """
+    scrape_state.update_one({'_id': 'answers'}, {'$set': {'last_id': last_id}}, upsert=True)
 
 # %%
+# CSS selectors used on every answer page. The code selector is scoped to the
+# answer cell in one query rather than looking up the cell and then its code.
+answer_selector = '.answer'
+snippet_selector = '.answercell pre > code'
+user_details_selector = '.post-signature .user-details > a'
+
+# Matches a user profile link, /users/:id/:name. The name segment is missing
+# for some accounts, in which case it is the link's text instead.
+user_href_pattern = re.compile(r'/users/(-?\d+)(?:/([^/?#]+))?')
+
 def scrape_stackoverflow_page(url: str) -> List[Dict]:
 
-    # Load the page into BeautifulSoup
+    # Load the page into selectolax's lexbor parser
+    page_bucket.acquire() # Don't spam the server, otherwise CloudFlare will complain
     r = session.get(url)
     html_doc = r.text
-    soup = BeautifulSoup(html_doc, 'html.parser')
+    tree = LexborHTMLParser(html_doc)
 
-    answers = soup.select('.answer')
+    answers = tree.css(answer_selector)
 
     answers_parsed = []
     for answer in answers:
-        answer_cell = answer.select_one('.answercell')
-
-        answer_id = int(answer['data-answerid'])
 
-        # Get all code snippet elements for the answer, skipping if there are none
-        snippet_elems = answer_cell.select('pre > code')
-        if not len(snippet_elems):
+        # Get all code snippet elements for the answer, skipping if there are
+        # none before doing any other work on it
+        snippet_elems = answer.css(snippet_selector)
+        if not snippet_elems:
             continue
 
+        attrs = answer.attributes
+        answer_id = int(attrs['data-answerid'])
+
         # Contains the user name and id of the answerer
-        user_details = answer.select_one('.post-signature .user-details > a')
+        user_details = answer.css_first(user_details_selector)
 
         # Extract the answer author's user id. Anonymous users have no user id
         if user_details is None:
             user_id = None
             user_name = 'anonymous'
         else:
-            _, _, user_id, user_name = user_details['href'].split('/') # takes form /users/:id/:name
-            user_id = int(user_id) # May be -1 if posted by 'community'
+            match = user_href_pattern.match(user_details.attributes.get('href') or '')
+            if match is None:
+                user_id = None
+                user_name = 'unknown'
+            else:
+                user_id = int(match.group(1)) # May be -1 if posted by 'community'
+                user_name = match.group(2) or user_details.text(strip=True)
 
         answer_data = {
             # 'question_id': question_id,
-            'snippets': '\n'.join([code_block.text for code_block in snippet_elems]),
-            'score': int(answer['data-score']),
+            'snippets': '\n'.join([code_block.text() for code_block in snippet_elems]),
+            'score': int(attrs['data-score']),
             'answer_id': answer_id,
-            'page_pos': int(answer['data-position-on-page']),
-            'is_highest_scored': answer['data-highest-scored'] == '1',
-            'question_has_highest_accepted_answer': answer['data-question-has-accepted-highest-score'] == '1',
+            'page_pos': int(attrs['data-position-on-page']),
+            'is_highest_scored': attrs['data-highest-scored'] == '1',
+            'question_has_highest_accepted_answer': attrs['data-question-has-accepted-highest-score'] == '1',
             # 'is_accepted': answer.has_class('accepted-answer'),
-            'is_accepted': 'accepted-answer' in answer['class'],
+            'is_accepted': 'accepted-answer' in (attrs.get('class') or '').split(),
             # 'source': answer.select_one('a.js-share-link').get('href').strip(),
             'source': f'https://stackoverflow.com/a/{answer_id}',
             'author_id': user_id,
@@ -226,34 +346,130 @@ def scrape_stackoverflow_page(url: str) -> List[Dict]:
 
     return answers_parsed
 
-# Test that the scraper works
-test_data = scrape_stackoverflow_page('https://stackoverflow.com/questions/69729326/endless-sine-generation-in-c')
+def selftest_scrape_stackoverflow_page() -> None:
+    """
+    Checks that the scraper works against a live question page.
+    """
+    test_data = scrape_stackoverflow_page('https://stackoverflow.com/questions/69729326/endless-sine-generation-in-c')
+
+    assert type(test_data) is list
+    assert len(test_data) > 0
+
+    for answer in test_data:
+        assert type(answer) is dict
+        # assert answer['question_id'] == 69729326 # This is the question we're scraping
+        assert 'snippets' in answer
+        assert 'score' in answer
+        assert 'answer_id' in answer
+        assert 'page_pos' in answer
+        assert 'is_highest_scored' in answer
+        assert 'question_has_highest_accepted_answer' in answer
+        assert 'is_accepted' in answer
+        assert 'source' in answer
+        assert 'author_id' in answer
+        assert 'author_username' in answer
+
+    print(test_data[0]['snippets'])
+
+# Hitting stackoverflow.com on every run is slow, so the self test is opt-in
+if os.getenv('RUN_SELFTEST'):
+    selftest_scrape_stackoverflow_page()
+
+# %%
+def scrape_stackoverflow_pages(links: List[str], max_workers: int = 8) -> List[Tuple[str, List[Dict]]]:
+    """
+    Scrapes several question pages at once, returning each link along with
+    the answers scraped from it.
+
+    Fetching answer pages is I/O bound, so they are downloaded on a small
+    pool of threads sharing the cached session. Request rate is governed by
+    `page_bucket`, and at most `max_workers` requests are in flight.
+    """
 
-assert type(test_data) is list
-assert len(test_data) > 0
+    def scrape_one(link: str) -> Tuple[str, List[Dict]]:
+        return link, scrape_stackoverflow_page(link)
 
-for answer in test_data:
-    assert type(answer) is dict
-    # assert answer['question_id'] == 69729326 # This is the question we're scraping
-    assert 'snippets' in answer
-    assert 'score' in answer
-    assert 'answer_id' in answer
-    assert 'page_pos' in answer
-    assert 'is_highest_scored' in answer
-    assert 'question_has_highest_accepted_answer' in answer
-    assert 'is_accepted' in answer
-    assert 'source' in answer
-    assert 'author_id' in answer
-    assert 'author_username' in answer
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(scrape_one, links))
 
-print(test_data[0]['snippets'])
+# %%
+class BulkWriter:
+    """
+    Writes operations to a collection from a background thread.
+
+    Operations are queued with `put()` and written in unordered batches of
+    `batch_size`, or whatever has queued up `interval` seconds after the first
+    one arrives, so scraping never waits on a mongo round trip. `flush()`
+    waits for everything queued so far to be written, and `close()` flushes
+    and stops the thread.
+    """
+
+    def __init__(self, collection, batch_size: int = 1000, interval: float = 0.5):
+        assert batch_size > 0 and interval > 0
+        self.collection = collection
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue: queue.Queue = queue.Queue()
+        self._error: Optional[Exception] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, op: UpdateOne) -> None:
+        self._raise_error()
+        self._queue.put(op)
+
+    def flush(self) -> None:
+        self._queue.join()
+        self._raise_error()
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self) -> None:
+        # Errors happen on the writer thread, re-raise them on the caller's
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self) -> None:
+        stop = False
+        while not stop:
+            op = self._queue.get()
+            if op is None:
+                self._queue.task_done()
+                return
+
+            # Collect a batch, waiting at most `interval` for it to fill up
+            batch = [op]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    op = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if op is None:
+                    self._queue.task_done()
+                    stop = True
+                    break
+                batch.append(op)
+
+            try:
+                self.collection.bulk_write(batch, ordered=False, bypass_document_validation=True)
+            except Exception as e:
+                self._error = e
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
 
 # %%
 drop = False         # Set to True to drop the collection before scraping
 page_size = 100      # The number of questions to scrape in each page
-start_page = 170     # The page to start scraping at, allows for resuming scraping after a crash
-should_scrape = True # Set to True to scrape the questions collection
-num_pages = int(questions.count_documents({}) / page_size)
+resume = True        # Start after the last checkpointed question, allows for resuming scraping after a crash
+should_scrape = False # Set to True to scrape answers for questions already in mongo
+max_workers = 8      # Number of answer pages to fetch at once
+bulk_size = 1000     # Number of answer upserts to buffer before writing them to mongo
 
 if should_scrape:
 
@@ -261,34 +477,105 @@ if should_scrape:
     if drop:
         print('Dropping answers collection') 
         answers.drop()
-
-    # Scrape each page of questions, bulk inserting answers into mongo
-    assert start_page > 0
-    for page_num in range(start_page, num_pages + 1):
-        # page_num = i + 1
-        print(f'Scraping page {page_num}/{num_pages} ', end = '')
-
-        for question in get_questions(page=page_num, pagesize=page_size):
-
-            # Get the answers for this question, skipping if no relevant answers are available
-            answers_data = scrape_stackoverflow_page(question['link'])
+        scrape_state.delete_one({'_id': 'answers'})
+
+    ensure_indexes()
+    scraped = get_scraped_question_ids()
+
+    # Stream questions from a single cursor, bulk inserting answers into mongo.
+    # Answers are written in large unordered batches on a background thread.
+    answer_writer = BulkWriter(answers, batch_size=bulk_size)
+    last_id = load_checkpoint() if resume else None
+    link_to_qid = get_question_links(last_id=last_id)
+    pending = iter(link_to_qid.items())
+    page_num = 0
+    while True:
+        page_links = list(islice(pending, page_size))
+        if not page_links:
+            break
+
+        page_num += 1
+        print(f'Scraping page {page_num} (after question {last_id}) ', end = '')
+
+        # Fetch the answers for every question on this page that hasn't been
+        # scraped yet concurrently
+        to_scrape = [link for link, question_id in page_links if question_id not in scraped]
+        for link, answers_data in scrape_stackoverflow_pages(to_scrape, max_workers=max_workers):
+
+            # Skip questions with no relevant answers
             if not len(answers_data):
                 print('x', end = '')
                 continue
 
-            # Add the question id to each answer
-            for answer_data in answers_data:
-                answer_data['question_id'] = question['question_id']
-
-            # Bulk insert the answers
-            upserts = [UpdateOne({'_id': answer['answer_id']}, {'$set': answer}, upsert=True) for answer in answers_data]
-            answers.bulk_write(upserts)
+            # Add the question id to each answer as it's written
+            question_id = link_to_qid[link]
+            for a in answers_data:
+                answer_writer.put(UpdateOne({'_id': a['answer_id']}, {'$set': {**a, 'question_id': question_id}}, upsert=True))
             print('.', end = '')
-            time.sleep(0.60 + random.random()) # Don't spam the server, otherwise CloudFlare will complain
 
+        # Make sure all of the page's answers are written before checkpointing
+        answer_writer.flush()
+
+        # All answers for this page are stored, move the checkpoint forward
+        last_id = page_links[-1][1]
+        save_checkpoint(last_id)
         print('')
 
+    answer_writer.close()
+
+# %% [markdown]
+# # Scraping Questions and Answers in One Pass
+# 
+# On a fresh scrape there's no need to store questions and then read them back out of mongo to find their answers. As each page of questions arrives from the API, its answer pages are fetched right away and the questions and answers are written together.
+
 # %%
+should_scrape = True # Set to True to scrape questions and their answers in a single pass
+drop = False         # Set to True to drop both collections before scraping
+page_size = 100      # Number of questions to return per API page
+page = 1             # Starting API page index, 1-indexed
+maxpages = 100       # Max number of API pages to scrape
+max_workers = 8      # Number of answer pages to fetch at once
+bulk_size = 1000     # Number of upserts to buffer before writing them to mongo
 
+if should_scrape:
+
+    if drop:
+        print('Dropping question and answer collections')
+        questions.drop()
+        answers.drop()
 
+    ensure_indexes()
+    scraped = get_scraped_question_ids()
 
+    question_writer = BulkWriter(questions, batch_size=bulk_size)
+    answer_writer = BulkWriter(answers, batch_size=bulk_size)
+
+    question_stream = get_stackoverflow_questions(page=page, maxpages=maxpages, pagesize=page_size)
+    while True:
+        page_questions = list(islice(question_stream, page_size))
+        if not page_questions:
+            break
+
+        for q in page_questions:
+            question_writer.put(UpdateOne({'_id': q['question_id']}, {'$set': q}, upsert=True))
+
+        # Fetch the answers for every question on this page that hasn't been
+        # scraped yet concurrently
+        link_to_qid = {q['link']: q['question_id'] for q in page_questions if q['question_id'] not in scraped}
+        print(f'Scraping {len(link_to_qid)} questions ', end = '')
+        for link, answers_data in scrape_stackoverflow_pages(list(link_to_qid), max_workers=max_workers):
+            if not len(answers_data):
+                print('x', end = '')
+                continue
+
+            question_id = link_to_qid[link]
+            for a in answers_data:
+                answer_writer.put(UpdateOne({'_id': a['answer_id']}, {'$set': {**a, 'question_id': question_id}}, upsert=True))
+            print('.', end = '')
+        print('')
+
+    # Write whatever is left over
+    question_writer.close()
+    answer_writer.close()
+
+# %%
@@ -0,0 +1,48 @@
+import threading
+import time
+
+class TokenBucket:
+    """
+    A thread-safe token bucket rate limiter.
+
+    Tokens refill at `rate` per second, up to `capacity`. `acquire()` blocks
+    until a token is available, so callers only wait when they are actually
+    going too fast. `pause()` empties the bucket for a while, which is how the
+    API's `backoff` field is honored.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        assert rate > 0 and capacity >= 1
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Takes a token from the bucket, blocking until one is available.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Empties the bucket and stops handing out tokens for `seconds`.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+            self._updated = self._paused_until
@@ -1,22 +1,174 @@
-from bs4 import BeautifulSoup
-from bs4.element import Tag
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import email.utils as eut
 import datetime
+from itertools import islice
+import logging
 from math import ceil
+from pymongo.collection import Collection
 from pymongo.database import Database
-from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from pymongo import InsertOne, UpdateOne
 import random
+import re
 import requests
+from requests.adapters import HTTPAdapter
 import requests_cache # https://requests-cache.readthedocs.io/en/stable/
+from selectolax.lexbor import LexborHTMLParser, LexborNode # https://selectolax.readthedocs.io/en/latest/lexbor.html
+import sys
+import threading
 import time
-from typing import Generator, List, Optional, Tuple, Union
-from scrape.types import RawStackOverflowAnswer, StackOverflowAnswer, StackOverflowQuestion
+from typing import Generator, Iterable, List, Optional, Tuple, Union
+from urllib3.util.retry import Retry
+from scrape.ratelimit import TokenBucket
+from scrape.types import QUESTION_FIELDS, RawStackOverflowAnswer, StackOverflowQuestion
 
-clamp = lambda a, b, x: max(min(x, b), a)
+logger = logging.getLogger(__name__)
+
+# orjson decodes API responses several times faster than the standard library,
+# but fall back to json if it isn't installed. Both accept raw bytes
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+# No questions posted more recently than this will be returned by get_questions
+_QUESTION_BOUNDARY_TS = int(datetime.datetime(2021, 12, 4).timestamp())
+
+# MongoDB error code for a duplicate key on insert
+_DUPLICATE_KEY = 11000
+
+# Matches links to a user's profile, capturing their id and, if present, their
+# name. The community user has an id of -1
+_USER_HREF_RE = re.compile(r'/users/(-?\d+)(?:/([^/?#]+))?')
+
+def _describe_node(node: LexborNode) -> str:
+    """
+    Describes an element by its tag name and attributes, without serializing
+    its children.
+    """
+    return f'<{node.tag} {node.attributes!r}>'
+
+def _parse_answers(html_doc: str) -> List[RawStackOverflowAnswer]:
+    """
+    Parses the answers with code snippets out of a question page's HTML. See
+    `StackOverflowScraper.scrape_answers` for the shape of each answer.
+
+    This is a module level function so it can be sent to worker processes.
+    """
+
+    # Everything before the answers container (head, question, comments) is
+    # thrown away, so don't spend time parsing it. Fall back to the whole
+    # page if the markup ever changes
+    answers_start = html_doc.find('<div id="answers"')
+    if answers_start > 0:
+        html_doc = html_doc[answers_start:]
+    tree = LexborHTMLParser(html_doc)
+
+    answers = tree.css('.answer')
+
+    answers_parsed = []
+    for answer in answers:
+        # Get all code snippet elements in the answer's body, skipping the
+        # answer if there are none (or it has no body at all)
+        snippet_elems = answer.css('.answercell pre > code')
+        if not snippet_elems:
+            continue
+
+        attrs = answer.attributes
+        answer_id = int(attrs['data-answerid'])
+
+        snippets: str = '\n'.join(code_block.text() for code_block in snippet_elems).strip()
+
+        if not snippets:
+            continue
+
+        # Contains the user name and id of the answerer
+        author_id, author_name = _scrape_user_details(answer)
+
+        answer_data: RawStackOverflowAnswer = {
+            # 'question_id': question_id,
+            'snippets': snippets,
+            'score': int(attrs['data-score']),
+            'answer_id': answer_id,
+            'page_pos': int(attrs['data-position-on-page']),
+            'is_highest_scored': attrs['data-highest-scored'] == '1',
+            'question_has_highest_accepted_answer': attrs['data-question-has-accepted-highest-score'] == '1',
+            'is_accepted': 'accepted-answer' in (attrs.get('class') or '').split(),
+            'source': f'https://stackoverflow.com/a/{answer_id}',
+            'author_id': author_id,
+            'author_username': author_name,
+        }
+
+        answers_parsed.append(answer_data)
+
+    return answers_parsed
+
+def _scrape_user_details(answer: LexborNode) -> Tuple[Union[int, None], str]:
+    """
+    Scrapes the username and user id of an answer's author.
+    """
+    assert answer
+
+    # Extract the answer author's user id. Anonymous users have no user id
+    user_details = answer.css('.post-signature .user-details > a')
+    if not user_details:
+        return None, 'anonymous'
+    else:
+        details: Optional[LexborNode] = None
+        try:
+            # Links still to check. Collective and history links may wrap
+            # the author link, so their children are queued up behind them
+            work = deque(user_details)
+
+            while work:
+                details = work.popleft()
+
+                # assert 'href' in details, 'No href attribute found in user details'
+
+                attrs = details.attributes
+                href = attrs.get('href') or ''
+                # has shape /users/:id/:name or /users/:id. In the latter
+                # case, the name is in the text of the anchor tag
+                match = _USER_HREF_RE.search(href)
+                if match:
+                    user_id = int(match.group(1))
+                    # Prolific users answer many questions, so share one copy
+                    # of their name across all of their answers
+                    user_name = sys.intern(match.group(2) or details.text().strip())
+                    return user_id, user_name
+
+                # Skip links to community wiki. Lexbor's css() matches the
+                # node itself as well as its descendants, so leave it out
+                elif 'collectives' in href:
+                    work.extend(link for link in details.css('a') if link != details)
+                    continue
+
+                # Skip history revision links
+                elif 'history' in (attrs.get('title') or ''):
+                    work.extend(link for link in details.css('a') if link != details)
+                    continue
+
+            if logger.isEnabledFor(logging.WARNING):
+                logger.warning('Could not find user details for answer %s', _describe_node(answer))
+            return None, 'unknown'
+
+        except Exception as e:
+            tag_text = _describe_node(details if details is not None else answer)
+            e.args += (f'Failed to parse user details from {tag_text}',)
+            raise e
 
 class StackOverflowScraper:
     """
     Scrapes StackOverflow for questions and answers.
+
+    The scraper holds an HTTP session open, so either call `close()` when done
+    with it or use it as a context manager:
+
+    ```python
+    with StackOverflowScraper(db=db) as stack:
+        stack.scrape_and_upsert(maxpages=10)
+    ```
     """
 
     def __init__(self, **kwargs):
@@ -26,28 +178,87 @@ class StackOverflowScraper:
         ## Keyword Arguments
 
         - `cache`   -- (str | requests_cache.CachedSession | False | None) The cache to use. If a string,
-                        it specifies the path to the cache directory. If False, no caching is used.
+                        it specifies the path to the SQLite cache database. If False, no caching is used.
                         If a requests_cache.CachedSession, it specifies the session to use. 
                         (default: `.cache/stack_cache`)
+        - `page_rate` -- (float) The maximum number of question pages to request
+                         per second, shared by all scraping threads. (default: 2)
+        - `pool_size` -- (int) The number of connections kept alive per host. Should be
+                         at least the `concurrency` passed to `scrape_and_upsert`.
+                         Ignored when a session is provided. (default: 64)
+        - `answer_cache_size` -- (int) The number of question pages whose parsed answers
+                                 are kept in memory. 0 disables the cache. (default: 2048)
+        - `parse_workers` -- (int) The number of processes to parse question pages in.
+                             If 0, pages are parsed on the scraping threads. (default: 0)
         """
         # May be a file path (str), a session object (CachedSession), False (no caching), or None (default)
-        cache: Union[str, bool, requests_cache.CachedSession] = kwargs.get('cache', '.cache/stack_cache')
+        cache: Union[str, bool, requests_cache.CachedSession, None] = kwargs.get('cache')
+        if cache is None:
+            cache = '.cache/stack_cache'
 
         if type(cache) is str:
-            self.session = requests_cache.CachedSession(cache, cache_control=True, stale_if_error=True, backend='filesystem')
+            # SQLite handles lots of small question pages better than one file per
+            # response. Stack Overflow's Cache-Control headers take precedence over
+            # the week long default expiry
+            self.session = requests_cache.CachedSession(
+                cache,
+                backend='sqlite',
+                expire_after=datetime.timedelta(days=7),
+                cache_control=True,
+                stale_if_error=True,
+            )
         elif type(cache) is requests_cache.CachedSession:
             self.session = cache
         else:
             self.session = requests.Session()
 
+        # Keep more connections alive for the concurrent page scrapes, and retry
+        # dropped connections and reads at the connection level. Error statuses
+        # (429 and 5xx) are only retried by _get, which backs off through the
+        # shared token buckets. Sessions passed in by the caller are left as
+        # they are
+        if cache is not self.session:
+            retries = Retry(total=3, connect=3, read=3, status=0, backoff_factor=0.5, raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=20, pool_maxsize=kwargs.get('pool_size', 64), max_retries=retries)
+            self.session.mount('https://', adapter)
+            self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+
+        # Rate limits for the API and for question pages. The API tolerates
+        # short bursts, stackoverflow.com sits behind CloudFlare and doesn't
+        self.api_bucket = TokenBucket(rate=2, capacity=5)
+        self.page_bucket = TokenBucket(rate=kwargs.get('page_rate', 2), capacity=4)
+
         # MongoDB database to store scraped data in
         self.db: Union[Database, None] = kwargs.get('db', None)
 
+        # Parsed answers for recently scraped question pages, least recently used
+        # first. Activity-sorted question pages often surface the same question
+        # again, and this skips re-parsing it even when the HTML is cached
+        self._answers_cache: 'OrderedDict[str, List[RawStackOverflowAnswer]]' = OrderedDict()
+        self._answers_cache_size: int = kwargs.get('answer_cache_size', 2048)
+        self._answers_cache_lock = threading.Lock()
+
+        # Optional process pool for parsing question pages
+        parse_workers: int = kwargs.get('parse_workers', 0)
+        self._parse_pool: Optional[ProcessPoolExecutor] = ProcessPoolExecutor(max_workers=parse_workers) if parse_workers > 0 else None
+
     
 
 
-    def __del__(self):
+    def close(self) -> None:
+        """
+        Closes the underlying HTTP session and its connection pools, and stops
+        the parsing processes if there are any.
+        """
         self.session.close()
+        if self._parse_pool is not None:
+            self._parse_pool.shutdown()
+
+    def __enter__(self) -> 'StackOverflowScraper':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
 
     def clean(self, only_expired=False):
         """Removes cached responses from the cache. 
@@ -79,7 +290,8 @@ class StackOverflowScraper:
         ## Keyword arguments:
 
         - `drop`     -- (bool) If True, drop the `question` and `answer`
-                        collections before scraping. (default: False)
+                        collections before scraping, and insert documents
+                        instead of upserting them. (default: False)
         - `pagesize` -- (int) The number of questions to retrieve per API call. Must
                         be 1<= `pagesize` <= 100. (default: 100)
         - `page`     -- (int) The page of questions to start at. Must be > 0.
@@ -87,9 +299,17 @@ class StackOverflowScraper:
         - `api_key`  -- (str | None) The Stack Overflow API key to use. (default: None)
         - `maxpages` -- (int) The maximum number of question batches to scrape,
                         each of size `pagesize`. (default: 10)
+        - `concurrency` -- (int) The number of question pages to scrape at the
+                           same time. (default: 8)
+        - `write_chunk` -- (int) The maximum number of upserts sent to MongoDB in
+                           a single bulk write. (default: 100)
         """
 
         drop: bool = kwargs.get('drop', False)
+        concurrency: int = kwargs.get('concurrency', 8)
+        assert concurrency >= 1
+        write_chunk: int = kwargs.get('write_chunk', 100)
+        assert write_chunk >= 1
 
         if self.db is None:
             raise Exception('No database provided')
@@ -111,59 +331,123 @@ class StackOverflowScraper:
             page = list(filter(lambda q: q['answer_count'] > 0 and q['score'] > 0, page))
             print(f'Removed {_page_init_size - len(page)} questions with no answers or low scores')
 
-            # Mark and store questions with no quality answers
-            marked_questions: List[int] = []
-            answers_to_store: List[StackOverflowAnswer] = []
+            # Upserts for questions with quality answers, and for those answers
+            questions_upsert: List[Union[InsertOne, UpdateOne]] = []
+            answers_upsert: List[Union[InsertOne, UpdateOne]] = []
 
             time_start = time.time()
             print(f'Scraping {len(page)} questions ', end='')
-            for q in page:
-
-                # Scrape answers for each question
-                try:
-                    raw_answers: List[RawStackOverflowAnswer] = self.scrape_answers(q['link'])
-                except Exception as e:
-                    link = q['link']
-                    e.args += (f'Failed to scrape question: {link}',)
-                    raise e
-
-                # Mark the question for removal if it has no quality answers
-                if not len(raw_answers):
-                    print('x', end = '', flush = True)
-                    marked_questions.append(q['question_id'])
-                    time.sleep(0.75)
-                    continue
-                else:
-                    print('.', end = '', flush = True)
 
-                # Add the question_id as a foreign key to the answers
-                answers: List[StackOverflowAnswer] = [{'question_id': q['question_id'], **answer} for answer in raw_answers]
+            # Local aliases for the per-question loop below
+            add_question = questions_upsert.append
+            add_answers = answers_upsert.extend
 
-                answers_to_store.extend(answers)
+            # Question pages are fetched concurrently. map() yields results in
+            # the same order as the page, and re-raises any scraping errors here
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                for q, raw_answers in executor.map(self._scrape_question, page):
 
-                # Sleep for a bit to avoid hitting the API too hard
-                time.sleep(0.60 + (2 * random.random() / 3))
+                    # Skip the question if it has no quality answers
+                    if not raw_answers:
+                        print('x', end = '', flush = True)
+                        continue
+                    else:
+                        print('.', end = '', flush = True)
+
+                    question_id = q['question_id']
+                    question_doc = {field: q[field] for field in QUESTION_FIELDS if field in q}
+
+                    # Add the question_id as a foreign key to the answers. After
+                    # a drop nothing can already exist, so skip the upsert lookups
+                    if drop:
+                        add_question(InsertOne({'_id': question_id, **question_doc}))
+                        add_answers(
+                            InsertOne({'_id': a['answer_id'], 'question_id': question_id, **a})
+                            for a in raw_answers
+                        )
+                    else:
+                        add_question(UpdateOne({'_id': question_id}, {'$set': question_doc}, upsert=True))
+                        add_answers(
+                            UpdateOne({'_id': a['answer_id']}, {'$set': {'question_id': question_id, **a}}, upsert=True)
+                            for a in raw_answers
+                        )
 
             print('')
 
-            # Remove questions with no quality answers
-            num_remove = len(marked_questions)
+            num_remove = len(page) - len(questions_upsert)
             if num_remove:
-                print(f'Removing {num_remove} questions with no quality answers (remaining: {len(page) - num_remove})')
-                page = list(filter(lambda q: q['question_id'] not in marked_questions, page))
+                print(f'Removed {num_remove} questions with no quality answers (remaining: {len(questions_upsert)})')
 
-            # Store the questions
-            questions_upsert = [UpdateOne({'_id': q['question_id']}, {'$set': q}, upsert=True) for q in page]
-            questions_result = self.db.questions.bulk_write(questions_upsert)
-
-            # Store the answers
-            answers_upsert = [UpdateOne({'_id': a['answer_id']}, {'$set': a}, upsert=True) for a in answers_to_store]
-            answers_result = self.db.answers.bulk_write(answers_upsert)
+            # Store the questions and their answers
+            questions_upserted = self._bulk_chunked(self.db.questions, questions_upsert, write_chunk)
+            answers_upserted = self._bulk_chunked(self.db.answers, answers_upsert, write_chunk)
 
             duration = time.time() - time_start
-            print(f'Stored {questions_result.upserted_count} questions and {answers_result.upserted_count} answers in {duration:,.2f} seconds')
+            print(f'Stored {questions_upserted} questions and {answers_upserted} answers in {duration:,.2f} seconds')
+
 
 
+    def _bulk_chunked(self, collection: Collection, ops: Iterable[Union[InsertOne, UpdateOne]], chunk: int = 100) -> int:
+        """
+        Splits `ops` into batches of at most `chunk` writes and sends them to
+        `collection` concurrently. Returns the total number of documents
+        inserted.
+
+        Large unordered batches are slower to apply than several smaller ones
+        sent at once, and a page of questions can produce a few hundred answer
+        upserts. `ops` may be any iterable, including a generator. It is cut
+        into list batches, since pymongo's bulk_write only accepts lists.
+        """
+        assert chunk > 0
+        if isinstance(ops, list) and len(ops) <= chunk:
+            return self._bulk_upsert(collection, ops)
+
+        ops = iter(ops)
+        batches = iter(lambda: list(islice(ops, chunk)), [])
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            return sum(executor.map(lambda batch: self._bulk_upsert(collection, batch), batches))
+
+    def _bulk_upsert(self, collection: Collection, ops: List[Union[InsertOne, UpdateOne]]) -> int:
+        """
+        Sends a batch of upserts (or plain inserts) to `collection` and returns
+        how many documents were inserted.
+
+        Each write is keyed by `_id` and independent of the others, so the
+        batch is unordered. MongoDB can then apply the writes in any order and
+        keeps going past individual failures, which are logged rather than
+        aborting the scrape. The collections have no validation rules, so the
+        server isn't asked to check the documents against them.
+        """
+        if not ops:
+            return 0
+
+        try:
+            result = collection.bulk_write(ops, ordered=False, bypass_document_validation=True)
+            return result.upserted_count + result.inserted_count
+        except BulkWriteError as e:
+            details = e.details
+            # Questions can show up on more than one page, so inserts into a
+            # freshly dropped collection may hit duplicate keys. Those are expected
+            errors = [error for error in details.get('writeErrors', []) if error.get('code') != _DUPLICATE_KEY]
+            if errors:
+                logger.warning('%d of %d writes to %s failed', len(errors), len(ops), collection.name)
+                for error in errors[0:5]:
+                    logger.warning('    %s: %s', error.get('code'), error.get('errmsg'))
+            return details.get('nUpserted', 0) + details.get('nInserted', 0)
+
+    def _scrape_question(self, q: StackOverflowQuestion) -> Tuple[StackOverflowQuestion, List[RawStackOverflowAnswer]]:
+        """
+        Scrapes the answers to a single question. Run by the worker threads in
+        `scrape_and_upsert`.
+        """
+        try:
+            raw_answers: List[RawStackOverflowAnswer] = self.scrape_answers(q['link'])
+        except Exception as e:
+            link = q['link']
+            e.args += (f'Failed to scrape question: {link}',)
+            raise e
+
+        return q, raw_answers
 
     def get_questions(self, **kwargs) -> Generator[List[StackOverflowQuestion], None, None]:
         """
@@ -200,71 +484,75 @@ class StackOverflowScraper:
 
         api_key: Optional[str] = kwargs.get('api_key')
 
-        question_boundary_younger = datetime.datetime(2021, 12, 4) # No questions posted more recently than this will be returned
         done = False # Set to True if we hit our request quota or no more question data is available
         requests_made = 0
-        _backoff = self._backoff()
 
-        # StackOverflow API query parameters common across all queries
-        base_query_params: dict = {
+        # StackOverflow API query parameters. Only `page` changes between requests
+        query_params: dict = {
             'site': 'stackoverflow',
             'sort': 'activity',
             'order': 'desc',
             'tagged': 'c',
             'pagesize': pagesize,
-            'todate': int(question_boundary_younger.timestamp())
+            'todate': _QUESTION_BOUNDARY_TS,
         }
 
         # Include the API key if one was provided
         if api_key:
-            base_query_params['key'] = api_key
+            query_params['key'] = api_key
 
-        while not done and requests_made < maxpages:
-            query_params = base_query_params.copy()
+        # Only one page is ever in flight, so the params can be updated in place
+        def fetch_page(page: int) -> requests.Response:
             query_params['page'] = page
-
-            print('================================================================================')
-            print(f'Requesting page #{page} ({requests_made}/{maxpages})')
             # Returns a Common Wrapper Object
             # https://api.stackexchange.com/docs/wrapper
-            r = self.session.get('https://api.stackexchange.com/2.3/questions', params=query_params)
-
-            content_type = r.headers.get('content-type', '')
-
-            # Handle request failures, particularly rate limiting
-            self._handle_response_error(r, _backoff)
-
-            # We're expecting JSON back
-            assert 'json' in content_type, f'Expected response to contain json, got {content_type}'
-
-            # Yield each question in the response
-            body = r.json()
-            # Extract data from the response
-            assert 'items' in body, f'API returned no items: {body}'
-            items: List[StackOverflowQuestion] = body['items']
-            quota_remaining: int = body['quota_remaining']
-            quota_max: int = body['quota_max']
-            has_more: bool = body['has_more']
-            backoff: int = body.get('backoff', 0)
-
-            # Sanity check response properties
-            assert isinstance(body['items'], list), f'Expected "items" property of response to be a list, got a {type(body["items"])}'
-
-            # Check if we're done
-            done = not has_more or quota_remaining <= 0
-
-            requests_made += 1
-            print(f'Got {pagesize} questions from page #{page} (#pages: {requests_made}/{maxpages}, quota: {quota_remaining}/{quota_max})')
-            yield items
-            page += 1
-
-            # print('\r', f'Got {pagesize} questions from page #{page} (quota: {quota_remaining}/{quota_max})', end='')
-
-            # Check if we need to back off before sending more requests. Only necessary if we're not done.
-            backoff = body.get('backoff', 0)
-            if not done and backoff > 0:
-                print(f'API requested backoff, sleeping for {backoff} seconds')
-                time.sleep(backoff)
+            return self._get('https://api.stackexchange.com/2.3/questions', self.api_bucket, params=query_params)
+
+        # The next page is requested in the background while the caller scrapes
+        # answers for the current one, so the API round trip is off the critical path
+        with ThreadPoolExecutor(max_workers=1) as prefetcher:
+            pending = prefetcher.submit(fetch_page, page)
+
+            while pending is not None:
+                r = pending.result()
+                pending = None
+
+                content_type = r.headers.get('content-type', '')
+
+                # We're expecting JSON back
+                assert 'json' in content_type, f'Expected response to contain json, got {content_type}'
+
+                # Yield each question in the response
+                body = _json_loads(r.content)
+                # Extract data from the response
+                assert 'items' in body, f'API returned no items: {body}'
+                items: List[StackOverflowQuestion] = body['items']
+                quota_remaining: int = body['quota_remaining']
+                quota_max: int = body['quota_max']
+                has_more: bool = body['has_more']
+
+                # Sanity check response properties
+                assert isinstance(body['items'], list), f'Expected "items" property of response to be a list, got a {type(body["items"])}'
+
+                # Check if we're done
+                done = not has_more or quota_remaining <= 0
+                requests_made += 1
+
+                if not done and requests_made < maxpages:
+                    # Check if we need to back off before sending more requests.
+                    # The pause must happen before the next page is queued up
+                    backoff: int = body.get('backoff', 0)
+                    if backoff > 0:
+                        print(f'API requested backoff, pausing for {backoff} seconds')
+                        self.api_bucket.pause(backoff)
+                    pending = prefetcher.submit(fetch_page, page + 1)
+
+                # Only report progress every few pages to keep the output readable
+                if requests_made == 1 or requests_made % 10 == 0:
+                    logger.info('Got %d questions from page #%d (#pages: %d/%d, quota: %d/%d)',
+                                len(items), page, requests_made, maxpages, quota_remaining, quota_max)
+                yield items
+                page += 1
 
     def scrape_answers(self, url: str) -> List[RawStackOverflowAnswer]:
         """
@@ -312,134 +600,78 @@ class StackOverflowScraper:
         A list of answer objects as dicts.
         """
 
-        # Load the page into BeautifulSoup
-        retry_after = 1
-        backoff = self._backoff()
-        r: Union[requests.Response, None] = None
-
-        while retry_after > 0:
-            r = self.session.get(url)
-            retry_after = self._handle_response_error(r, backoff)
-        assert r is not None
-
-        html_doc = r.text
-        soup = BeautifulSoup(html_doc, 'html.parser')
-
-        answers = soup.select('.answer')
-
-        answers_parsed = []
-        for answer in answers:
-            answer_cell = answer.select_one('.answercell')
+        with self._answers_cache_lock:
+            cached = self._answers_cache.get(url)
+            if cached is not None:
+                self._answers_cache.move_to_end(url)
+                return [dict(answer) for answer in cached]
 
-            if not answer_cell:
-                continue
+        # Don't spam the server, otherwise CloudFlare will complain
+        r = self._get(url, self.page_bucket)
 
-            answer_id = int(answer['data-answerid'])
-
-            # Get all code snippet elements for the answer, skipping if there are none
-            snippet_elems = answer_cell.select('pre > code')
-            if not len(snippet_elems):
-                continue
-
-            snippets: str =  '\n'.join([code_block.text for code_block in snippet_elems])
-            snippets = snippets.strip()
-
-            if not snippets:
-                continue
-
-            # Contains the user name and id of the answerer
-            author_id, author_name = self._scrape_user_details(answer)
+        # Parsing is CPU bound, so it can be handed to a pool of processes
+        # instead of competing with the other scraping threads for the GIL
+        if self._parse_pool is not None:
+            answers_parsed = self._parse_pool.submit(_parse_answers, r.text).result()
+        else:
+            answers_parsed = _parse_answers(r.text)
 
-            answer_data: RawStackOverflowAnswer = {
-                # 'question_id': question_id,
-                'snippets': snippets,
-                'score': int(answer['data-score']),
-                'answer_id': answer_id,
-                'page_pos': int(answer['data-position-on-page']),
-                'is_highest_scored': answer['data-highest-scored'] == '1',
-                'question_has_highest_accepted_answer': answer['data-question-has-accepted-highest-score'] == '1',
-                'is_accepted': 'accepted-answer' in answer['class'],
-                'source': f'https://stackoverflow.com/a/{answer_id}',
-                'author_id': author_id,
-                'author_username': author_name,
-            }
+        # Answers only hold plain values, so shallow copies keep callers from
+        # changing what's cached
+        if self._answers_cache_size > 0:
+            with self._answers_cache_lock:
+                self._answers_cache[url] = [dict(answer) for answer in answers_parsed]
+                if len(self._answers_cache) > self._answers_cache_size:
+                    self._answers_cache.popitem(last=False)
 
-            answers_parsed.append(answer_data)
+        return list(answers_parsed)
 
-        return answers_parsed
+    def _get(self, url: str, bucket: TokenBucket, **kwargs) -> requests.Response:
+        """
+        Sends a GET request through `bucket`, retrying it when the server rate
+        limits us or has a transient error.
 
-    def _scrape_user_details(self, answer: Tag) -> Tuple[Union[int, None], str]:
+        Backoff pauses the whole bucket rather than just this thread, so every
+        worker talking to the same host slows down together. Any other error is
+        raised by `_handle_response_error`.
         """
-        Scrapes the username and user id of an answer's author.
+        attempt = 0
+        while True:
+            bucket.acquire()
+            r = self.session.get(url, **kwargs)
+            if not self._handle_response_error(r, attempt, bucket=bucket):
+                return r
+            attempt += 1
+
+    def _handle_response_error(self, r: requests.Response, attempt: int = 0, max_attempts: int = 5, bucket: Optional[TokenBucket] = None) -> float:
+        """
+        Checks a response for errors. Returns 0 if the request succeeded, or
+        the number of seconds waited before it should be retried. If `bucket`
+        is given it is paused for that long, otherwise the calling thread sleeps.
         """
-        assert answer
-
-        # Extract the answer author's user id. Anonymous users have no user id
-        user_details = answer.select('.post-signature .user-details > a')
-        if user_details is None or len(user_details) == 0:
-            return None, 'anonymous'
-        else:
-            try:
-                user_details = list(user_details)
-                # TODO: unravel user_details list
-
-                for details in user_details:
-
-                    # assert 'href' in details, 'No href attribute found in user details'
-
-                    if 'users' in details['href']:
-                        # has shape /user/:id/:name or /user/:id. In the latter
-                        # case, the name is in the text of the anchor tag
-                        link = details['href']
-                        assert type(link) is str
-                        link = link.strip(' /')
-                        link = [seg.strip() for seg in link.split('/')]
-                        assert len(link) > 1 and 'users' in link[0]
-                        link = link[1:]
-                        user_id = int(link.pop(0))
-                        if len(link) > 0:
-                            user_name = link.pop(0)
-                        else:
-                            user_name = details.text.strip()
-
-                        assert user_id is not None and user_name is not None
-                        return user_id, user_name
-
-                    # Skip links to community wiki
-                    elif 'collectives' in details['href']:
-                        user_details.extend(details.select('a'))
-                        continue
-
-                    # Skip history revision links
-                    elif 'title' in details.attrs and 'history' in details.attrs['title']:
-                        user_details.extend(details.select('a'))
-                        continue
-
-                print(f'WARNING: Could not find user details for answer {answer.prettify()[0:64]}...')
-                return None, 'unknown'
-
-            except Exception as e:
-                # tag_tex = if details then details.prettify() else answer.prettify()[0:64]
-                tag_text = details.prettify() if details else answer.prettify()[0:64]
-                e.args += (f'Failed to parse user details from {tag_text}',)
-                raise e
-
-    def _handle_response_error(self, r: requests.Response, _backoff: Generator[float, None, None]) -> float:
         if 200 <= r.status_code < 300:
             return 0
 
         content_type = r.headers.get('content-type', '')
         content_length = r.headers.get('content-length', 0)
 
-        # Too many requests, try slowing down
-        if r.status_code == 429:
+        # Too many requests or a transient server error, try slowing down
+        if r.status_code == 429 or r.status_code >= 500:
+            # Give up once we've retried as many times as we're willing to
+            if attempt >= max_attempts:
+                r.raise_for_status()
+
             retry_after = self._get_retry_after(r)
             if retry_after:
-                print(f'Too many requests, got retry-after, retrying in {retry_after:.2f} seconds')
+                print(f'Got {r.status_code} with retry-after, retrying in {retry_after:.2f} seconds')
+            else:
+                retry_after = self._backoff(attempt)
+                print(f'Got {r.status_code}, using exp backoff, retrying in {retry_after:.2f} seconds')
+
+            if bucket is not None:
+                bucket.pause(retry_after)
             else:
-                retry_after = _backoff.__next__()
-                print(f'Too many requests, using exp backoff, retrying in {retry_after:.2f} seconds')
-            time.sleep(retry_after)
+                time.sleep(retry_after)
             return retry_after
 
         # No error details provided in body, just raise the error
@@ -448,15 +680,16 @@ class StackOverflowScraper:
 
         # Try to extract error details from the response body
         elif 'json' in content_type:
-            error_json = r.json()
+            error_json = _json_loads(r.content)
             raise requests.HTTPError(f'{r.status_code} {r.reason} API returned error {error_json["error_id"]}: {error_json["error_message"]}')
             
         # Try to extract error details from the response body
         else:
             raise requests.HTTPError(f'{r.status_code} {r.reason}: {r.text}')
 
-    def _backoff(self, **kwargs):
-        """Performs exponential backoff with jitter
+    def _backoff(self, attempt: int, **kwargs) -> float:
+        """Computes the exponential backoff with jitter for the `attempt`-th retry
+        (0-indexed)
 
         """
         base: int = kwargs.get('base', 1)
@@ -465,13 +698,9 @@ class StackOverflowScraper:
         cap: int = kwargs.get('cap', 128)
         assert cap > 0
 
-        n_attempts: int = kwargs.get('n_attempts', 10)
-        assert n_attempts > 1
-
-        temp = [clamp(2, cap, base * 2 ** (i + 1))
-                for i in range(n_attempts)]
-        backoff: List[float] = [(3/4) * t + random.uniform(0, 1/4 * t) for t in temp]
-        yield from backoff
+        # base >= 1, so the shift is always at least 2
+        t = min(cap, base << (attempt + 1))
+        return (3/4) * t + random.uniform(0, 1/4 * t)
 
     def _get_retry_after(self, r: requests.Response) -> Union[int, None]:
         """
@@ -496,13 +725,14 @@ class StackOverflowScraper:
             return retry_after
 
         # Retry-After is the seconds to wait before sending another request 
-        elif retry_after.isdigit():
+        try:
             return int(retry_after)
+        except (TypeError, ValueError):
+            pass
 
         # Retry-After is a [date](https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Date)
         # in the format of "Wed, 31 Dec 2020 23:59:59 GMT"
-        else:
-            retry_at = eut.parsedate_to_datetime(retry_after)
-            now = datetime.datetime.now()
-            wait_duration = retry_at - now
-            return ceil(wait_duration.total_seconds())
\ No newline at end of file
+        retry_at = eut.parsedate_to_datetime(retry_after)
+        now = datetime.datetime.now()
+        wait_duration = retry_at - now
+        return ceil(wait_duration.total_seconds())
\ No newline at end of file
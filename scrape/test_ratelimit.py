@@ -0,0 +1,26 @@
+import time
+from scrape.ratelimit import TokenBucket
+
+def test_burst_up_to_capacity():
+    bucket = TokenBucket(rate=1, capacity=3)
+
+    start = time.monotonic()
+    for _ in range(3):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.1
+
+def test_acquire_waits_for_refill():
+    bucket = TokenBucket(rate=20, capacity=1)
+    bucket.acquire()
+
+    start = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start >= 0.04
+
+def test_pause_blocks_acquire():
+    bucket = TokenBucket(rate=100, capacity=5)
+    bucket.pause(0.1)
+
+    start = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start >= 0.09
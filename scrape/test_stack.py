@@ -1,10 +1,11 @@
 import pytest
-from scrape.stack import StackOverflowScraper
+from scrape.stack import StackOverflowScraper, _parse_answers
 from scrape.types import is_raw_stackoverflow_answer
 
 @pytest.fixture()
 def stack():
-    return StackOverflowScraper(cache_path='.cache/stack_scraper_tests')
+    with StackOverflowScraper(cache_path='.cache/stack_scraper_tests') as scraper:
+        yield scraper
 
 def test_scrape_stackoverflow_page(stack: StackOverflowScraper):
     assert type(stack) is StackOverflowScraper
@@ -53,4 +54,34 @@ def test_scrape_stackoverflow_page(stack: StackOverflowScraper):
 def test_scrape_malformed_page(stack: StackOverflowScraper):
     url = 'https://stackoverflow.com/questions/26260906/voronoi-diagram-bound-by-circular-tour'
     test_data = stack.scrape_answers(url)
-    assert len(test_data) == 0
\ No newline at end of file
+    assert len(test_data) == 0
+
+def test_parse_answers_offline():
+    html_doc = '''
+    <div id="question"><pre><code>not an answer</code></pre></div>
+    <div id="answers">
+        <div class="answer accepted-answer" data-answerid="12" data-score="7" data-position-on-page="1"
+             data-highest-scored="1" data-question-has-accepted-highest-score="1">
+            <div class="answercell">
+                <pre><code>int main(void) { return 0; }</code></pre>
+                <div class="post-signature">
+                    <div class="user-details"><a href="/users/42/jane-doe">Jane Doe</a></div>
+                </div>
+            </div>
+        </div>
+        <div class="answer" data-answerid="13" data-score="1" data-position-on-page="2"
+             data-highest-scored="0" data-question-has-accepted-highest-score="1">
+            <div class="answercell"><p>No code here</p></div>
+        </div>
+    </div>
+    '''
+    answers = _parse_answers(html_doc)
+
+    assert len(answers) == 1
+    answer = answers[0]
+    assert is_raw_stackoverflow_answer(answer)
+    assert answer['answer_id'] == 12
+    assert answer['snippets'] == 'int main(void) { return 0; }'
+    assert answer['is_accepted'] and answer['is_highest_scored']
+    assert answer['author_id'] == 42
+    assert answer['author_username'] == 'jane-doe'
@@ -1,4 +1,5 @@
 # Test script to see if scrape/stack.py works
+import logging
 import os
 from dotenv import load_dotenv
 from pymongo import MongoClient
@@ -8,6 +9,7 @@ import datetime
 import time
 
 load_dotenv()
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 
 page_start: int = 1193
 maxpages: int = 200
@@ -37,14 +39,15 @@ def get_mongo_client() -> MongoClient:
     else:
         assert not user and not pw, 'MONGO_USERNAME and MONGO_PASSWORD must both be set or both be unset'
 
-    client = MongoClient(mongo_uri, tls=True)
+    # Keep enough connections open for the concurrent bulk writes
+    client = MongoClient(mongo_uri, tls=True, maxPoolSize=100, compressors='zlib',
+                         retryWrites=True, w=1, maxIdleTimeMS=60000)
     return client
 
 apiKey = os.getenv('STACKOVERFLOW_API_KEY')
 client = get_mongo_client()
 db = client['stackOverflowDB']
 db.command('ping')
-stack = StackOverflowScraper(db=db)
 
 print('--------------------------------------------------------------------------------')
 print(f'----------------- Scraping started at {datetime.datetime.now()} ----------------')
@@ -52,6 +55,7 @@ print('-------------------------------------------------------------------------
 print('')
 
 start = time.time()
-stack.scrape_and_upsert(drop=False, api_key=apiKey, page=page_start, maxpages=maxpages)
+with StackOverflowScraper(db=db) as stack:
+    stack.scrape_and_upsert(drop=False, api_key=apiKey, page=page_start, maxpages=maxpages)
 duration = time.time() - start
 print(f'Finished scraping {maxpages} pages in {duration:,.2f} seconds')
\ No newline at end of file
@@ -1,15 +1,122 @@
-from typing import Dict, Type, TypeVar, TypedDict, List, Tuple, Union, NewType, Literal
-from pycparser import CParser, c_lexer, parse_file
-from pycparser.c_lexer import CLexer
+from typing import TYPE_CHECKING, Dict, Iterable, Optional, Type, TypeVar, TypedDict, List, Tuple, NewType, Literal
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+import hashlib
+import json
+import shutil
 import subprocess
+import sys
+import tempfile
+import threading
 import os
 
-from pycparser.ply.lex import LexToken
+# pycparser is imported where it's used, since loading its parser tables is
+# slow and most runs check snippets with gcc/clang instead
+if TYPE_CHECKING:
+    from pycparser import CParser
+    from pycparser.c_lexer import CLexer
+    from pycparser.ply.lex import LexToken
 
 # List of potential programs for parsing C/C++
 # 'cc' is intentionally not included
 _programs = ['gcc', 'g++', 'c++', 'clang', 'clang++']
 
+# Value of `SnippetCleaner.cc`/`cpp` when no compiler is available and pycparser
+# is used instead. Being a plain string keeps cleaners picklable
+_PYCPARSER = '_pycparser'
+
+# Max snippets checked per compiler invocation, keeps the command line short
+_CC_BATCH_SIZE = 256
+
+# Seconds before a compiler invocation is given up on
+_CC_TIMEOUT = 60
+
+# Token types for identifiers and keywords. `SnippetLexer` reports every
+# identifier as a TYPEID
+_C_WORD_TOKENS = frozenset({'ID', 'TYPEID', 'AUTO', 'BREAK', 'CASE', 'CHAR', 'CONST', 'CONTINUE',
+                            'DEFAULT', 'DO', 'DOUBLE', 'ELSE', 'ENUM', 'EXTERN', 'FLOAT', 'FOR',
+                            'GOTO', 'IF', 'INLINE', 'INT', 'LONG', 'REGISTER', 'RESTRICT', 'RETURN',
+                            'SHORT', 'SIGNED', 'SIZEOF', 'STATIC', 'STRUCT', 'SWITCH', 'TYPEDEF',
+                            'UNION', 'UNSIGNED', 'VOID', 'VOLATILE', 'WHILE'})
+
+# Token values shorter than this are interned. Keywords, operators and most
+# identifiers repeat constantly, longer values (e.g. string literals) rarely do
+_INTERN_MAX_LEN = 32
+
+# Lexers used to pre-filter snippets, one per thread since they're stateful
+_prefilter_lexers = threading.local()
+
+def _prefilter(snippet: str) -> Optional['ParserOutput']:
+    """
+    Cheaply rejects snippets that can't be C (prose punctuation, numbers, a lone
+    word, ...) without starting a compiler. Returns the failed `ParserOutput` for
+    rejected snippets, or None if the snippet needs a real check.
+
+    This is deliberately lenient: lexer errors alone don't reject a snippet,
+    since `CLexer` doesn't understand comments.
+    """
+    lexer: Optional[SnippetLexer] = getattr(_prefilter_lexers, 'lexer', None)
+    if lexer is None:
+        lexer = _prefilter_lexers.lexer = SnippetLexer()
+
+    toks, _status = lexer.lex(snippet)
+    # Every declaration needs at least an identifier or keyword, plus something after it
+    if len(toks) < 2 or not any(tok.type in _C_WORD_TOKENS for tok in toks):
+        return {'success': False, 'errors': ['no C tokens'], 'warnings': []}
+    return None
+
+def _snippet_key(snippet: str) -> bytes:
+    """
+    Content hash used to key `SnippetCleaner`'s parse cache.
+    """
+    return hashlib.blake2b(snippet.encode('utf-8', errors='surrogatepass'), digest_size=16).digest()
+
+@lru_cache(maxsize=None)
+def _parser_version(prog: str) -> str:
+    """
+    Identifies the exact parser behind `prog`, so disk cached results are
+    invalidated when the compiler (or this module) changes.
+    """
+    if prog == _PYCPARSER:
+        import pycparser
+        version = pycparser.__version__.encode()
+    else:
+        try:
+            version = subprocess.run([prog, '--version'], stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL, timeout=_CC_TIMEOUT).stdout
+        except (OSError, subprocess.TimeoutExpired):
+            version = b''
+
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(prog.encode())
+    digest.update(version)
+    digest.update(str(os.path.getmtime(__file__)).encode())
+    return digest.hexdigest()
+
+@lru_cache(maxsize=2)
+def _find_cc_progs(verify: bool = False) -> Dict[str, bool]:
+    """
+    Looks up which compiler programs are on the PATH. This only stats the PATH
+    directories rather than running each compiler, and is done once per process.
+
+    With `verify`, each program is run with `--version` instead, which also
+    catches broken or stub compilers on the PATH.
+    """
+    if not verify:
+        return {prog: shutil.which(prog) is not None for prog in _programs}
+
+    result: Dict[str, bool] = {}
+    for prog in _programs:
+        try:
+            completed_prog = subprocess.run(
+                [prog, '--version'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            result[prog] = completed_prog.returncode == 0
+        except OSError:
+            result[prog] = False
+
+    return result
+
 class ParserOutput(TypedDict):
     success: bool
     warnings: List[str]
@@ -22,33 +129,57 @@ class SnippetCleaner:
     def __init__(self, **kwargs):
         self.verbose: bool = kwargs.get('verbose', False)
 
+        # Created on first use when pycparser is the selected parser
+        self._cparser: Optional['CParser'] = None
+
+        # Reject snippets that obviously aren't C before running a compiler on them
+        self.prefilter: bool = kwargs.get('prefilter', True)
+
+        # StackOverflow answers repeat the same snippets a lot, so parse results
+        # are kept in an LRU cache keyed by the snippet's content hash. Set
+        # `parse_cache_size` to 0 to disable it
+        self._parse_cache: 'OrderedDict[bytes, ParserOutput]' = OrderedDict()
+        self._parse_cache_size: int = kwargs.get('parse_cache_size', 10_000)
+        self._parse_cache_lock = threading.Lock()
+
         # self.cc = self.cpp = CParser()
         cc_override = kwargs.get('cc_override', kwargs.get('override', None))
         cpp_override = kwargs.get('cpp_override', kwargs.get('override', None))
-        self._init_parsers(cc_override, cpp_override)
-
-    def _init_parsers(self, cc_override=None, cpp_override=None):
+        # Set `verify_cc` (or the `SNIPPET_CC_PROBE` environment variable) to make
+        # sure compilers actually run, not just that they're on the PATH
+        self._init_parsers(cc_override, cpp_override, verify=kwargs.get('verify_cc', False))
+
+        # Parse results can also be kept on disk, so re-runs over the same
+        # snippets (e.g. ~/.cache/snippet_cleaner) skip the compiler entirely.
+        # Results are stored per parser version
+        cache_dir: Optional[str] = kwargs.get('cache_dir', None)
+        self._cache_dir: Optional[str] = None
+        if cache_dir:
+            self._cache_dir = os.path.join(os.path.expanduser(cache_dir), _parser_version(self.cc))
+            os.makedirs(self._cache_dir, exist_ok=True)
+
+    def _init_parsers(self, cc_override=None, cpp_override=None, verify=False):
         """
         TODO: Use this if pycparser doesn't come through
         """
         # Dict of all available C/C++ compiler programs.
-        ccs = self._get_available_cc_progs()
+        ccs = self._get_available_cc_progs(verify)
 
         # Determine which C parser to use.
         if cc_override:
-            assert cc_override in ccs
-            self.cc: Union[str, CParser]  = cc_override
+            assert cc_override in ccs or cc_override == _PYCPARSER
+            self.cc: str = cc_override
         elif ccs['gcc']:
             self.cc = 'gcc'
         elif ccs['clang']:
             self.cc = 'clang'
         else:
-            self.cc = CParser()
+            self.cc = _PYCPARSER
 
         # Determine which C++ parser to use.
         if cpp_override:
-            assert cpp_override in ccs
-            self.cpp: Union[str, CParser] = cpp_override
+            assert cpp_override in ccs or cpp_override == _PYCPARSER
+            self.cpp: str = cpp_override
         elif ccs['g++']:
             self.cpp = 'g++'
         elif ccs['clang++']:
@@ -58,42 +189,77 @@ class SnippetCleaner:
         elif ccs['gcc']:  # Fallback to gcc (TODO: is this okay to do?)
             self.cpp = 'gcc'
         else:
-            self.cpp = CParser()
+            self.cpp = _PYCPARSER
 
-    def _get_available_cc_progs(self) -> Dict[str, bool]:
+    def _get_cparser(self) -> 'CParser':
         """
-        Checks for available C/C++ compiler programs.
-        Returns a dictionary containing the names of the available C/C++ compiler, 
-        and a boolean indicating if the compiler is available.
+        Returns this cleaner's pycparser parser, creating it on first use.
         """
-
-        result: dict = {}
-        for prog in _programs:
+        if self._cparser is None:
+            from pycparser import CParser
+            self._cparser = CParser()
+        return self._cparser
+
+    def __getstate__(self) -> dict:
+        # PLY parsers and locks don't pickle, so worker processes in
+        # `parse_many` get their own, along with an empty parse cache
+        state = self.__dict__.copy()
+        state['_cparser'] = None
+        state['_parse_cache'] = OrderedDict()
+        del state['_parse_cache_lock']
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._parse_cache_lock = threading.Lock()
+
+    def _get_cached(self, key: bytes) -> Optional[ParserOutput]:
+        with self._parse_cache_lock:
+            cached = self._parse_cache.get(key)
+            if cached is not None:
+                self._parse_cache.move_to_end(key)
+                return cached
+
+        if self._cache_dir is not None:
             try:
-                completed_prog = subprocess.run(
-                    [prog, '--version'], stdout=None, stderr=None)
-                result[prog] = completed_prog.returncode == 0
-            except:
-                result[prog] = False
+                with open(os.path.join(self._cache_dir, key.hex() + '.json')) as f:
+                    cached = json.load(f)
+            except (OSError, ValueError):
+                return None
+            self._set_cached(key, cached, disk=False)
+        return cached
+
+    def _set_cached(self, key: bytes, result: ParserOutput, disk: bool = True):
+        if disk and self._cache_dir is not None:
+            # Write to a temporary file first so readers never see a partial result
+            path = os.path.join(self._cache_dir, key.hex() + '.json')
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            try:
+                with open(tmp_path, 'w') as f:
+                    json.dump(result, f)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                if self.verbose:
+                    print(f'Failed to cache parse result: {e}')
 
-        return result
+        if self._parse_cache_size <= 0:
+            return
+        with self._parse_cache_lock:
+            self._parse_cache[key] = result
+            if len(self._parse_cache) > self._parse_cache_size:
+                self._parse_cache.popitem(last=False)
 
-    def _parse_cc_output(self, output: Union[subprocess.CalledProcessError, subprocess.CompletedProcess]) -> ParserOutput:
+    def _get_available_cc_progs(self, verify: bool = False) -> Dict[str, bool]:
         """
-        """
-        stdout: str = output.stdout.decode('utf-8') if output.stdout is not None else ''
-        stderr: str = output.stderr.decode('utf-8') if output.stderr is not None else ''
-        logs = stdout.split('\n') + stderr.split('\n')
+        Checks for available C/C++ compiler programs.
+        Returns a dictionary containing the names of the available C/C++ compiler, 
+        and a boolean indicating if the compiler is available.
 
-        errors = list(filter(lambda err: 'error' in err, logs))
-        warnings = list(filter(lambda warn: 'warn' in warn, logs))
+        If `verify` is set, compilers are run to check that they work.
+        """
 
-        success = len(errors) == 0 and (output.returncode == 0 if isinstance(output, subprocess.CompletedProcess) else False)
-        return {
-            'success': success,
-            'errors': errors,
-            'warnings': warnings
-        }
+        verify = verify or bool(os.getenv('SNIPPET_CC_PROBE'))
+        return dict(_find_cc_progs(verify))
 
     def _check_c_snippet(self, snippet: str, name='') -> ParserOutput:
         """
@@ -101,30 +267,14 @@ class SnippetCleaner:
         TODO
         """
 
-        # Analyze the code snippet with gcc or clang frontend
+        # Check the code snippet with the gcc or clang frontend
         if self.cc == 'gcc' or self.cc == 'clang':
-            prog: Literal['gcc', 'clang'] = self.cc
-
-            # Run gcc/clang on the snippet
-            try:
-                status = subprocess.run(
-                    [prog, '--analyze', '--analyzer-output', 'sarif', '-x', 'c', '-'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, input=snippet.encode(), check=True)
-                return self._parse_cc_output(status)
-                # return {'success': True, 'warnings': [], 'errors': []}
-
-            # Warnings or errors occurred, parse the output
-            except subprocess.CalledProcessError as e:
-                return self._parse_cc_output(e)
-
-            except subprocess.TimeoutExpired as e:
-                if self.verbose:
-                    print(f'Timeout: {e}')
-                return {'success': False, 'errors': [], 'warnings': []}
+            return self._check_c_snippets([snippet])[0]
 
         # Use pycparser to parse the code snippet and check if it is valid C code
-        elif isinstance(self.cc, CParser):
+        if self.cc == _PYCPARSER:
             try:
-                parser: CParser = self.cc
+                parser = self._get_cparser()
                 parser.parse(snippet, name, 1 if self.verbose else 0)
                 return {'success': True, 'warnings': [], 'errors': []}
 
@@ -134,12 +284,95 @@ class SnippetCleaner:
         else:
             raise TypeError(f'Unknown compiler: {self.cc}')
 
+    def _check_c_snippets(self, snippets: List[str]) -> List[ParserOutput]:
+        """
+        Checks if each code snippet is valid C code using a single gcc/clang
+        invocation for all of them.
+
+        Each snippet is written to its own file in a temporary directory, so the
+        compiler treats them as separate translation units. Diagnostics are
+        matched back to their snippet by the file name they start with. Starting
+        the compiler costs far more than checking a typical snippet, so this is
+        much faster than one invocation per snippet.
+        """
+        if not snippets:
+            return []
+
+        prog: Literal['gcc', 'clang'] = self.cc
+        names = [f'snippet{i}.c' for i in range(len(snippets))]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, snippet in zip(names, snippets):
+                with open(os.path.join(tmp, name), 'w', encoding='utf-8') as f:
+                    f.write(snippet)
+
+            # Only validity matters, so skip everything after parsing and type
+            # checking. Diagnostics are demultiplexed as the compiler prints them
+            # instead of buffering all of its output first
+            timed_out = threading.Event()
+            with subprocess.Popen([prog, '-fsyntax-only', *names], cwd=tmp,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.PIPE) as proc:
+                def kill():
+                    timed_out.set()
+                    proc.kill()
+
+                timer = threading.Timer(_CC_TIMEOUT, kill)
+                timer.start()
+                try:
+                    results = self._demux_cc_output(proc.stderr, names)
+                    returncode = proc.wait()
+                finally:
+                    timer.cancel()
+
+        if timed_out.is_set():
+            if self.verbose:
+                print(f'Timeout: {prog} took longer than {_CC_TIMEOUT} seconds')
+            return [{'success': False, 'errors': [], 'warnings': []} for _ in snippets]
+
+        # The compiler failed without blaming any snippet (e.g. a bad flag), so
+        # none of them can be trusted
+        if returncode != 0 and all(result['success'] for result in results):
+            for result in results:
+                result['success'] = False
+
+        return results
+
+    def _demux_cc_output(self, lines: Iterable[bytes], names: List[str]) -> List[ParserOutput]:
+        """
+        Splits a batched compiler run's diagnostic lines into one `ParserOutput`
+        per input file, in the same order as `names`.
+        """
+        results: Dict[str, ParserOutput] = {name: {'success': True, 'errors': [], 'warnings': []} for name in names}
+        # Lines are matched as raw bytes, and only the diagnostics that are kept
+        # get decoded
+        by_prefix: Dict[bytes, ParserOutput] = {name.encode(): result for name, result in results.items()}
+
+        for line in lines:
+            # Diagnostics look like "snippet3.c:4:5: error: ...". Context lines
+            # (source excerpts, "In function ...") are skipped
+            result = by_prefix.get(line.split(b':', 1)[0])
+            if result is None:
+                continue
+            if b'error:' in line:
+                result['errors'].append(line.rstrip().decode('utf-8', errors='replace'))
+                result['success'] = False
+            elif b'warning:' in line:
+                result['warnings'].append(line.rstrip().decode('utf-8', errors='replace'))
+
+        return [results[name] for name in names]
+
     # Parses a code snippet and checks if it is valid C code. If the check fails,
     # it checks if the snippet is valid C++ code. Returns a tuple containing
     # two booleans, the first one indicating if the code snippet is valid C code,
     # the second one indicating if the code snippet is valid C++ code.
     def parse(self, snippet: str, name: str = '') -> Tuple[bool, bool]:
-        c_parse_result = self._check_c_snippet(snippet, name)
+        key = _snippet_key(snippet)
+        c_parse_result = self._get_cached(key)
+        if c_parse_result is None and self.prefilter:
+            c_parse_result = _prefilter(snippet)
+        if c_parse_result is None:
+            c_parse_result = self._check_c_snippet(snippet, name)
+            self._set_cached(key, c_parse_result)
         if self.verbose:
             print(f'Errors: {c_parse_result["errors"]}')
             print(f'Warnings: {c_parse_result["warnings"]}')
@@ -147,40 +380,113 @@ class SnippetCleaner:
         # TODO: Check if the code snippet is valid C++ code
         return (c_parse_result['success'], False)
 
+    def parse_many(self, snippets: Iterable[str], max_workers: Optional[int] = None, chunksize: Optional[int] = None) -> List[Tuple[bool, bool]]:
+        """
+        Parses many code snippets in parallel, returning the `parse` result for
+        each snippet in order.
+
+        With gcc or clang, snippets are checked in batches of up to
+        `_CC_BATCH_SIZE` per compiler invocation, with batches run on up to
+        `max_workers` threads. With pycparser they are spread across a pool of
+        `max_workers` processes (default: one per CPU) in chunks of `chunksize`
+        (default: about four chunks per worker). Snippets that are repeated or
+        were already parsed by this cleaner are only checked once.
+        """
+        snippets = list(snippets)
+        keys = [_snippet_key(snippet) for snippet in snippets]
+
+        # Only check each distinct snippet that isn't already cached, once
+        outputs: Dict[bytes, ParserOutput] = {}
+        pending: Dict[bytes, str] = {}
+        for key, snippet in zip(keys, snippets):
+            if key in outputs or key in pending:
+                continue
+            cached = self._get_cached(key)
+            if cached is None and self.prefilter:
+                cached = _prefilter(snippet)
+            if cached is not None:
+                outputs[key] = cached
+            else:
+                pending[key] = snippet
+        todo = list(pending.values())
+
+        if self.cc == 'gcc' or self.cc == 'clang':
+            batches = [todo[i:i + _CC_BATCH_SIZE] for i in range(0, len(todo), _CC_BATCH_SIZE)]
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                checked = [result for batch in executor.map(self._check_c_snippets, batches) for result in batch]
+        elif todo:
+            workers = max_workers or os.cpu_count() or 1
+            if chunksize is None:
+                chunksize = max(1, len(todo) // (4 * workers))
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                checked = list(executor.map(self._check_c_snippet, todo, chunksize=chunksize))
+        else:
+            checked = []
+
+        for key, result in zip(pending, checked):
+            outputs[key] = result
+            self._set_cached(key, result)
+
+        return [(outputs[key]['success'], False) for key in keys]
+
+def _noop():
+    pass
 
 LexerStatus = Literal['pending', 'running', 'error', 'success']
 class SnippetLexer:
-    def __init__(self):
-        self._lexer = CLexer(error_func=self._on_error, on_lbrace_func=self._on_lbrace,
-                             on_rbrace_func=self._on_rbrace, type_lookup_func=self._type_lookup)
+    def __init__(self, **kwargs):
+        # Keyword arguments are passed through to `CLexer.build`. Building
+        # compiles PLY's lexer tables, so lexers are built on first use and
+        # then kept, one per set of build options
+        self._lexer: Optional['CLexer'] = None
+        self._lexers: Dict[tuple, 'CLexer'] = {}
+        self._build_kwargs = kwargs
         # 'pending', 'running', 'error', 'success'
         self.status: LexerStatus = 'pending'
         self.errors: List[str] = [] 
         self.brace_depth = 0
 
-    def lex(self, snippet: str, **kwargs) -> Tuple[List[LexToken], LexerStatus]:
+    def lex(self, snippet: str, **kwargs) -> Tuple[List['LexToken'], LexerStatus]:
         """
         Lexes a code snippet and returns a tuple containing the lexed snippet and
         the lexer's status. The status can be 'pending', 'running', 'error', or 'success'.
 
         If the lexer's status is 'error', the errors list will contain a list of
         error messages.
+
+        Keyword arguments lex with those `CLexer.build` options instead of the
+        ones given to the constructor. The lexer for each set of options is only
+        built once.
         """
         
         self.reset()
-        toks: List[LexToken] = []
+        toks: List['LexToken'] = []
 
         self.status = 'running'
 
-        self._lexer.build(**kwargs)
+        self._lexer = self._get_lexer(kwargs or self._build_kwargs)
+        self._lexer.reset_lineno()
         self._lexer.input(snippet)
-        # self._lexer.token()
 
-        while True:
-            tok = self._lexer.token()
-            if not tok:
-                break
-            toks.append(tok)
+        # `token()` returns None once the input is exhausted. Letting `iter`
+        # drive it keeps the loop out of Python bytecode
+        toks.extend(iter(self._lexer.token, None))
+
+        # Braces are counted here in one pass instead of through a callback per
+        # brace. Every token value is a new slice of the snippet, so the common
+        # ones are shared while we're at it
+        depth = 0
+        for tok in toks:
+            if tok.type == 'LBRACE':
+                depth += 1
+            elif tok.type == 'RBRACE':
+                depth -= 1
+                if depth < 0:
+                    self.status = 'error'
+                    self.errors.append('Unbalanced braces')
+            if len(tok.value) < _INTERN_MAX_LEN:
+                tok.value = sys.intern(tok.value)
+        self.brace_depth = depth
 
         # Check for hanging open braces
         if self.brace_depth > 0:
@@ -190,6 +496,20 @@ class SnippetLexer:
         self.status = 'success' if self.status == 'running' else self.status
         return (toks, self.status)
 
+    def _get_lexer(self, build_kwargs: dict) -> 'CLexer':
+        """
+        Returns the lexer built with `build_kwargs`, building it on first use.
+        """
+        key = tuple(sorted(build_kwargs.items()))
+        lexer = self._lexers.get(key)
+        if lexer is None:
+            from pycparser.c_lexer import CLexer
+            lexer = CLexer(error_func=self._on_error, on_lbrace_func=_noop,
+                           on_rbrace_func=_noop, type_lookup_func=self._type_lookup)
+            lexer.build(**build_kwargs)
+            self._lexers[key] = lexer
+        return lexer
+
     def reset(self):
         """
         Resets the lexer's internal state after lexing a snippet.
@@ -202,15 +522,6 @@ class SnippetLexer:
     def _type_lookup(self, token):
         return True
 
-    def _on_lbrace(self):
-        self.brace_depth += 1
-
-    def _on_rbrace(self):
-        self.brace_depth -= 1
-        if self.brace_depth < 0:
-            self.status = 'error'
-            self.errors.append('Unbalanced braces')
-
     def _on_error(self, msg, _line, _column):
         self.status = 'error'
         self.errors.append(msg)
@@ -1,6 +1,7 @@
-import os
 from posix import listdir
-from typing import Dict, TypedDict, NewType, Literal, List
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, TypedDict, NewType, Literal, List, Tuple
 import pytest
 from transform.snippet import SnippetCleaner
 
@@ -10,7 +11,7 @@ class TestCase(TypedDict):
 TestCase.__test__ = False
 
 TestCases = NewType('TestCases', Dict[Literal['valid', 'invalid'], Dict[Literal['c', 'cpp'], List[TestCase]]])
-@pytest.fixture(scope="function")
+@pytest.fixture(scope="module")
 def snippet_cleaner():
     return SnippetCleaner(verbose=True)
 
@@ -27,48 +28,102 @@ def test_cases() -> TestCases:
         },
     }
 
-    this_dir = os.path.dirname(os.path.abspath(__file__))
-    test_dir = os.path.join(this_dir, '__test__')
-
-    for root, dirs, files in os.walk(test_dir):
-        for file in files:
-            # valid is either 'valid' or 'invalid'
-            name, valid, ext = file.split('.')
-            if not valid in _test_cases.keys():
-                print(f'Skipping invalid test case file: {file}')
-                continue
-
-            test_case: TestCase = {
-                'name': os.path.abspath(os.path.join(root, file)),
-                'content': open(os.path.join(root, file)).read()
-            }
-
-            # append the file name to the appropriate list list
-            if ext in ['c', 'h']:
-                _test_cases[valid]['c'].append(test_case)
-            elif ext in ['cpp', 'hpp']:
-                _test_cases[valid]['cpp'].append(test_case)
-            else:
-                print(f'Unknown file extension "{ext}" for test case {file}, skipping')
+    test_dir = Path(__file__).resolve().parent / '__test__'
+
+    # Find the test case files first, then read them all at once
+    found: List[Tuple[Path, str, str]] = []
+    for path in test_dir.rglob('*'):
+        if not path.is_file():
+            continue
+        # Names look like "<name>.<valid>.<ext>", where the name may contain dots
+        # and valid is either 'valid' or 'invalid'
+        parts = path.name.rsplit('.', 2)
+        if len(parts) != 3 or not parts[1] in _test_cases.keys():
+            print(f'Skipping invalid test case file: {path.name}')
+            continue
+        found.append((path, parts[1], parts[2]))
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        contents = list(executor.map(Path.read_text, [path for path, _, _ in found]))
+
+    for (path, valid, ext), content in zip(found, contents):
+        test_case: TestCase = {
+            'name': str(path),
+            'content': content
+        }
+
+        # append the file name to the appropriate list list
+        if ext in ['c', 'h']:
+            _test_cases[valid]['c'].append(test_case)
+        elif ext in ['cpp', 'hpp']:
+            _test_cases[valid]['cpp'].append(test_case)
+        else:
+            print(f'Unknown file extension "{ext}" for test case {path.name}, skipping')
 
     return _test_cases
 
 
 # @pytest.mark.usefixtures("snippet_cleaner", "test_cases")
 def test_valid_c(snippet_cleaner: SnippetCleaner, test_cases: TestCases):
-    for test_case in test_cases['valid']['c']:
-        print(test_case)
-        # name, content = test_case
-        # print(name)
-        # print(content)
-        is_valid_c, _ = snippet_cleaner.parse(test_case['content'], test_case['name'])
+    cases = test_cases['valid']['c']
+    results = snippet_cleaner.parse_many([test_case['content'] for test_case in cases])
+    for test_case, (is_valid_c, _) in zip(cases, results):
         assert is_valid_c, f'{test_case["name"]} is not valid C'
 
 def test_invalid_c(snippet_cleaner: SnippetCleaner, test_cases: TestCases):
-    for test_case in test_cases['invalid']['c']:
-        print(test_case)
-        # name, content = test_case
-        # print(name)
-        # print(content)
-        is_valid_c, _ = snippet_cleaner.parse(test_case['content'], test_case['name'])
+    cases = test_cases['invalid']['c']
+    results = snippet_cleaner.parse_many([test_case['content'] for test_case in cases])
+    for test_case, (is_valid_c, _) in zip(cases, results):
         assert not is_valid_c, f'{test_case["name"]} is valid C'
+
+def test_parse_many_matches_parse(snippet_cleaner: SnippetCleaner, test_cases: TestCases):
+    cases = test_cases['valid']['c'] + test_cases['invalid']['c']
+    snippets = [test_case['content'] for test_case in cases]
+
+    # Without caching, parse_many has to check every snippet itself rather than
+    # reuse what parse found
+    cleaner = SnippetCleaner(cc_override=snippet_cleaner.cc, parse_cache_size=0, prefilter=False)
+    expected = [cleaner.parse(snippet) for snippet in snippets]
+    assert cleaner.parse_many(snippets, max_workers=2) == expected
+
+def test_parse_many_pycparser():
+    cleaner = SnippetCleaner(cc_override='_pycparser')
+    snippets = ['int main(void) { return 0; }', 'int x = ;', 'int add(int a, int b) { return a + b; }']
+
+    expected = [cleaner.parse(snippet) for snippet in snippets]
+    assert expected == [(True, False), (False, False), (True, False)]
+    assert cleaner.parse_many(snippets, max_workers=2) == expected
+
+def test_parse_cache_dedupes_snippets(snippet_cleaner: SnippetCleaner):
+    cleaner = SnippetCleaner(cc_override=snippet_cleaner.cc, parse_cache_size=2)
+    snippets = ['int main(void) { return 0; }', 'int x = ;', 'int main(void) { return 0; }']
+
+    assert cleaner.parse_many(snippets) == [(True, False), (False, False), (True, False)]
+    assert len(cleaner._parse_cache) == 2
+    assert cleaner.parse('int x = ;') == (False, False)
+
+    cleaner.parse('int y;')
+    assert len(cleaner._parse_cache) == 2
+
+def test_prefilter_rejects_non_c(snippet_cleaner: SnippetCleaner):
+    snippets = ['', '42', '+= ;', 'int main(void) { return 0; }']
+
+    assert snippet_cleaner.parse_many(snippets) == [(False, False), (False, False), (False, False), (True, False)]
+    assert [snippet_cleaner.parse(snippet) for snippet in snippets] == [(False, False), (False, False), (False, False), (True, False)]
+
+def test_parse_disk_cache(snippet_cleaner: SnippetCleaner, tmp_path: Path):
+    snippets = ['int main(void) { return 0; }', 'int x = ;']
+    cleaner = SnippetCleaner(cc_override=snippet_cleaner.cc, cache_dir=str(tmp_path))
+    expected = cleaner.parse_many(snippets)
+
+    # A fresh cleaner should answer from disk without checking anything
+    cached = SnippetCleaner(cc_override=snippet_cleaner.cc, cache_dir=str(tmp_path))
+    def fail(*args, **kwargs):
+        raise AssertionError('snippet was checked instead of read from the cache')
+    cached._check_c_snippet = fail
+    cached._check_c_snippets = fail
+
+    assert [cached.parse(snippet) for snippet in snippets] == expected
+
+def test_parse_non_ascii(snippet_cleaner: SnippetCleaner):
+    assert snippet_cleaner.parse_many(['const char *greeting = "héllo ✓";']) == [(True, False)]
@@ -48,4 +48,18 @@ def test_snippet_lexer_unbalanced_rbrace(lexer: SnippetLexer):
     assert len(toks) == 5
     assert status == 'error'
     assert len(lexer.errors) == 1
-    assert lexer.errors[0] == 'Unbalanced braces'
\ No newline at end of file
+    assert lexer.errors[0] == 'Unbalanced braces'
+
+def test_snippet_lexer_reuses_built_lexer(lexer: SnippetLexer):
+    lexer.lex('int x;')
+    built = lexer._lexer
+
+    toks, status = lexer.lex('int main() { return 0; }')
+    assert lexer._lexer is built
+    assert len(toks) == 9
+    assert status == 'success'
+
+    lexer.lex('int x;', optimize=False)
+    assert lexer._lexer is not built
+    lexer.lex('int x;')
+    assert lexer._lexer is built
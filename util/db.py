@@ -5,9 +5,17 @@ from pymongo.cursor import Cursor
 from pymongo.collection import Collection
 from scrape.types import StackOverflowAnswer, StackOverflowQuestion
 from urllib.parse import quote_plus
-from typing import Generator, Any
+from typing import Dict, Generator, Any, List, Optional
 
 load_dotenv()
+
+# Documents fetched per round trip when reading a whole collection. The server
+# default is 101 for the first batch
+_ALL_BATCH_SIZE = 1000
+
+def _projection(fields: Optional[List[str]]) -> Optional[Dict[str, int]]:
+    return {field: 1 for field in fields} if fields else None
+
 class Database:
     """
     A utility class that wraps a MongoDB database.
@@ -42,7 +50,9 @@ class Database:
         else:
             assert not user and not pw, 'MONGO_USERNAME and MONGO_PASSWORD must both be set or both be unset'
 
-        self._client = MongoClient(mongo_uri, tls=True)
+        # Analysis reads whole collections, so compress what comes back over the
+        # wire. zlib is built into Python, unlike zstd/snappy
+        self._client = MongoClient(mongo_uri, tls=True, compressors='zlib')
         self._db = self._client['stackOverflowDB']
         self._questions = self._db['questions']
         self._answers = self._db['answers']
@@ -55,46 +65,94 @@ class Database:
     def questions(self) -> Collection:
         return self._questions
   
-    def get_questions(self, page_num: int = 1, **kwargs: int) -> Generator[StackOverflowQuestion, None, None]:
+    def get_questions(self, page_num: Optional[int] = None, fields: Optional[List[str]] = None, **kwargs: int) -> Generator[StackOverflowQuestion, None, None]:
         """
         Returns a generator of questions from the StackOverflow database
 
         # Arguments
             page_num: The starting page number to retrieve questions from. Page
                       numbers are 1-indexed. Defaults to 1.
+            fields:   Only retrieve these fields of each document (`_id` is
+                      always included). Defaults to all fields.
 
         ## Keyword Arguments
             page_size: The number of questions to retrieve per page. Defaults to 100.
+            after_id:  Only retrieve questions whose `_id` comes after this one,
+                       instead of skipping to `page_num`. Pass the `_id` of the
+                       last document from the previous page to get the next
+                       page, which is much faster than skipping deep pages.
+                       Cannot be combined with `page_num`.
             
         """
 
-        return self._paginate(self._questions, page_num, **kwargs)
+        if 'after_id' in kwargs:
+            if page_num is not None:
+                raise ValueError('page_num and after_id cannot both be given')
+            return self._paginate_by_id(self._questions, fields=fields, **kwargs)
+        return self._paginate(self._questions, page_num or 1, fields=fields, **kwargs)
 
-    def get_answers(self, page_num: int = 1, **kwargs: int) -> Generator[StackOverflowAnswer, None, None]:
+    def get_answers(self, page_num: Optional[int] = None, fields: Optional[List[str]] = None, **kwargs: int) -> Generator[StackOverflowAnswer, None, None]:
         """
         Returns a generator of answers from the StackOverflow database
 
         # Arguments
             page_num: The starting page number to retrieve questions from. Page
                       numbers are 1-indexed. Defaults to 1.
+            fields:   Only retrieve these fields of each document (`_id` is
+                      always included). Defaults to all fields.
 
         ## Keyword Arguments
             page_size: The number of questions to retrieve per page. Defaults to 100.
+            after_id:  Only retrieve answers whose `_id` comes after this one,
+                       instead of skipping to `page_num`. Pass the `_id` of the
+                       last document from the previous page to get the next
+                       page, which is much faster than skipping deep pages.
+                       Cannot be combined with `page_num`.
             
         """
 
-        return self._paginate(self._answers, page_num, **kwargs)
+        if 'after_id' in kwargs:
+            if page_num is not None:
+                raise ValueError('page_num and after_id cannot both be given')
+            return self._paginate_by_id(self._answers, fields=fields, **kwargs)
+        return self._paginate(self._answers, page_num or 1, fields=fields, **kwargs)
 
-    def get_all_answers(self) -> Generator[StackOverflowAnswer, None, None]:
+    def get_all_answers(self, fields: Optional[List[str]] = None) -> Generator[StackOverflowAnswer, None, None]:
         """
         Returns a generator of all answers from the StackOverflow database
+
+        # Arguments
+            fields: Only retrieve these fields of each answer (`_id` is always
+                    included), e.g. `['snippets']`. Defaults to all fields.
         """
 
-        cursor =  self._answers.find()
+        # Fetch answers in large batches to cut down on round trips to the server
+        cursor = self._answers.find(projection=_projection(fields)).batch_size(_ALL_BATCH_SIZE)
         for doc in cursor:
             yield doc
 
-    def _paginate(self, collection: Collection, page_num: int = 1, **kwargs: int) -> Generator[Any, None, None]:
+    def get_code_answers(self, fields: Optional[List[str]] = None) -> Generator[StackOverflowAnswer, None, None]:
+        """
+        Returns a generator of all answers that contain code snippets.
+
+        Answers without snippets are filtered out by the server instead of
+        being sent over and skipped here.
+
+        # Arguments
+            fields: Only retrieve these fields of each answer (`_id` is always
+                    included). Defaults to `['snippets']`.
+        """
+
+        pipeline = [
+            # Matches non-empty strings only
+            {'$match': {'snippets': {'$gt': ''}}},
+            {'$project': _projection(fields or ['snippets'])},
+        ]
+        cursor = self._answers.aggregate(pipeline, allowDiskUse=True, batchSize=_ALL_BATCH_SIZE)
+        for doc in cursor:
+            yield doc
+
+    def _paginate(self, collection: Collection, page_num: int = 1, fields: Optional[List[str]] = None, **kwargs: int) -> Generator[Any, None, None]:
         assert type(page_num) == int and page_num > 0, 'page_num must be a positive integer'
 
         page_size = kwargs.get('page_size', 100) # How many pages to return
@@ -104,6 +162,17 @@ class Database:
         skips = page_size * (page_num - 1)
 
         # Skip and limit
-        cursor: Cursor = collection.find().skip(skips).limit(page_size)
+        cursor: Cursor = collection.find(projection=_projection(fields)).skip(skips).limit(page_size)
+        for doc in cursor:
+            yield doc
+
+    def _paginate_by_id(self, collection: Collection, after_id: Optional[int] = None, fields: Optional[List[str]] = None, **kwargs: int) -> Generator[Any, None, None]:
+        page_size = kwargs.get('page_size', 100) # How many documents to return
+        assert type(page_size) == int and page_size > 0, 'page_size must be a positive integer'
+
+        # The server has to walk past every skipped document, so deep pages get
+        # slower and slower. Ranging over `_id` uses its index instead
+        query = {'_id': {'$gt': after_id}} if after_id is not None else {}
+        cursor: Cursor = collection.find(query, projection=_projection(fields)).sort('_id', 1).limit(page_size)
         for doc in cursor:
             yield doc